@@ -1,13 +1,16 @@
 """base class for pilexif manager"""
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
 from pathlib import Path
 import logging
+import sqlite3
 import struct
+import threading
 
 import piexif
 from PIL import Image, UnidentifiedImageError
 
-from kjmarotools.basics import logtools, convert
+from kjmarotools.basics import logtools
 
 
 class PrivateTools:
@@ -17,58 +20,289 @@ class PrivateTools:
     --------------------------------------------------------------------------
     """
     # pylint: disable=too-few-public-methods
+    __slots__ = ()
+    JPEG_EXTENSIONS = "JPG", "JPEG"
+    EXIF_HEAD_SIZE = 80000
+    EXIF_CACHE_FILENAME = "pilexif_cache.sqlite"
+    GPS_SCALE = 100
+    EXIF_CACHE_PAYLOADS = "exif", "icc_profile", "photoshop"
+    EXIF_DATA_CACHE_SIZE = 128
+    _exif_data_cache: 'OrderedDict[Tuple[str, int, int], dict]' = OrderedDict()
+    _exif_data_lock = threading.Lock()
+    _exif_cache_local = threading.local()
+    _exif_cache_schemas: Set[Path] = set()
 
     @staticmethod
-    def _load_metadata(file2load: Path) -> dict:
+    def _scan_jpeg_segments(data: bytes) -> dict:
         """
-        Get all the metadata in the image as it is stored in the file.
+        Walk the JPEG APP markers in <data> (up to the image scan) and
+        return the metadata payloads as Pillow names them in <img.info>:
+        'exif' (APP1), 'icc_profile' (APP2) and 'photoshop' (APP13, raw).
+        Raises ValueError if <data> is not a JPEG or if it is truncated.
         """
-        img = Image.open(file2load)
-        data_dict: Dict[str, dict] = {}
-        for kwd in img.info:
+        if data[0:2] != b'\xff\xd8':
+            raise ValueError("Wrong JPEG data")
+        info: Dict[str, bytes] = {}
+        icc_chunks: List[Tuple[int, bytes]] = []
+        idx = 2
+        while idx + 4 <= len(data):
+            if data[idx] != 0xFF:
+                raise ValueError("Wrong JPEG data")
+            marker = data[idx + 1]
+            if marker == 0xFF:
+                idx += 1
+                continue
+            if marker in (0xDA, 0xD9):
+                if icc_chunks:
+                    info['icc_profile'] = b"".join(
+                        chunk for _, chunk in sorted(icc_chunks))
+                return info
+            end = idx + 2 + struct.unpack_from('>H', data, idx + 2)[0]
+            if end > len(data):
+                raise ValueError("Truncated JPEG data")
+            payload = data[idx + 4:end]
+            if marker == 0xE1 and payload[:6] == b'Exif\x00\x00':
+                info.setdefault('exif', payload)
+            elif marker == 0xE2 and payload[:12] == b'ICC_PROFILE\x00':
+                if len(payload) < 14:  # no chunk sequence number/count
+                    raise ValueError("Wrong JPEG data")
+                icc_chunks.append((payload[12], payload[14:]))
+            elif marker == 0xED and payload[:14] == b'Photoshop 3.0\x00':
+                info['photoshop'] = payload[14:]
+            idx = end
+        raise ValueError("Truncated JPEG data")
+
+    @staticmethod
+    def _read_jpeg_info(file2load: Path) -> dict:
+        """
+        Get the metadata payloads of a JPEG reading only the head of the
+        file. The whole file is read only if the head is not enough.
+        """
+        with open(file2load, 'rb') as fhd:
+            data = fhd.read(PrivateTools.EXIF_HEAD_SIZE)
+            try:
+                return PrivateTools._scan_jpeg_segments(data)
+            except ValueError:
+                if len(data) < PrivateTools.EXIF_HEAD_SIZE:
+                    raise
+                data += fhd.read()
+        return PrivateTools._scan_jpeg_segments(data)
+
+    @staticmethod
+    def _read_pillow_info(file2load: Path) -> dict:
+        """
+        Get <img.info> of the image opened by Pillow (opening is lazy, the
+        pixels are never decoded)
+        """
+        with Image.open(file2load) as img:
+            return img.info
+
+    @staticmethod
+    def _read_info(file2load: Path) -> dict:
+        """
+        Get the raw metadata entries of the image as stored in the file.
+        JPEG files are read directly without Pillow (Pillow is only used
+        if the file is not a well-formed JPEG).
+        """
+        if file2load.suffix[1:].upper() in PrivateTools.JPEG_EXTENSIONS:
             try:
-                data_dict[kwd] = piexif.load(img.info[kwd])
-            except UnidentifiedImageError:
-                data_dict[kwd] = img.info[kwd]
-            except TypeError:
-                data_dict[kwd] = img.info[kwd]
+                return PrivateTools._read_jpeg_info(file2load)
             except ValueError:
-                data_dict[kwd] = img.info[kwd]
-            except OSError:
-                data_dict[kwd] = img.info[kwd]
+                pass
+        return PrivateTools._read_pillow_info(file2load)
+
+    @staticmethod
+    def _parse_info(info: dict) -> dict:
+        """raw metadata entries with the 'exif' one parsed by piexif"""
+        data_dict: Dict[str, dict] = {}
+        for kwd, val in info.items():
+            if kwd != 'exif':
+                data_dict[kwd] = val
+                continue
+            try:
+                data_dict[kwd] = piexif.load(val)
             except struct.error:
                 data_dict[kwd] = {}
+            except (UnidentifiedImageError, TypeError, ValueError, OSError):
+                data_dict[kwd] = val
         return data_dict
 
     @staticmethod
-    def _load_exif_data(file2load: Path, add_basic_keywords=True) -> dict:
+    def _load_metadata(file2load: Path) -> dict:
+        """Get all the metadata in the image as it is stored in the file"""
+        return PrivateTools._parse_info(PrivateTools._read_info(file2load))
+
+    @staticmethod
+    def _exif_data_from_info(info: dict, add_basic_keywords=False) -> dict:
+        """
+        Get the exif and metadata of the raw <info> entries arranged and
+        adds the basic missing keys if <add_basic_keywords> is enabled
+        """
+        data_dict = PrivateTools._parse_info(info)
+        exif_dict = data_dict.pop('exif', {})
+        exif_dict.update(data_dict)
+
+        if add_basic_keywords:
+            for kwd in ("Exif", "0th", "1st", "GPS"):
+                exif_dict.setdefault(kwd, {})
+        return exif_dict
+
+    @staticmethod
+    def _load_exif_data(file2load: Path, add_basic_keywords=False) -> dict:
         """
         Get the exif and metadata in the file arranged and adds
         the basic missing keys if <add_basic_keywords> is enabled
         """
-        data_dict = PrivateTools._load_metadata(file2load)
-        exif_dict = {}
-        if 'exif' in list(data_dict.keys()):
-            exif_dict = data_dict['exif']
+        return PrivateTools._exif_data_from_info(
+            PrivateTools._read_info(file2load), add_basic_keywords)
 
-        for kwd in list(data_dict.keys()):
-            if kwd != 'exif':
-                exif_dict[kwd] = data_dict[kwd]
+    @staticmethod
+    def _read_exif_data(file2load: Path) -> Tuple[dict, dict]:
+        """(raw info entries, arranged exif data) of the file"""
+        info = PrivateTools._read_info(file2load)
+        return info, PrivateTools._exif_data_from_info(info)
 
-        if add_basic_keywords:
-            kwds2add = ["Exif", "0th", "1st", "GPS"]
-            for kwd in kwds2add:
-                if kwd not in exif_dict:
-                    exif_dict[kwd] = {}
-        return exif_dict
+    @staticmethod
+    def _try_read_exif_data(file2load: Path) -> Optional[Tuple[dict, dict]]:
+        """
+        <_read_exif_data> of the file or None if it cannot be read, so one
+        bad file does not stop a process pool (load_file raises the error)
+        """
+        try:
+            return PrivateTools._read_exif_data(file2load)
+        except Exception:  # pylint: disable=broad-except
+            return None
+
+    @staticmethod
+    def _copy_exif_data(exif_data: dict) -> dict:
+        """copy of the exif data down to the ifd dicts (tags are immutable)"""
+        return {kwd: dict(val) if isinstance(val, dict) else val
+                for kwd, val in exif_data.items()}
+
+    @classmethod
+    def _get_cached_exif_data(cls, key: Tuple[str, int, int]
+                              ) -> Optional[dict]:
+        """
+        Copy of the exif data cached in memory for <key> = <_file_key>
+        (None if missing). A changed file has a new key, so it is a miss
+        """
+        with cls._exif_data_lock:
+            exif_data = cls._exif_data_cache.get(key)
+            if exif_data is None:
+                return None
+            cls._exif_data_cache.move_to_end(key)
+        return cls._copy_exif_data(exif_data)
+
+    @classmethod
+    def _put_cached_exif_data(cls, key: Tuple[str, int, int],
+                              exif_data: dict) -> None:
+        """cache a copy of the exif data (dropping the least recent ones)"""
+        exif_data = cls._copy_exif_data(exif_data)
+        with cls._exif_data_lock:
+            cls._exif_data_cache[key] = exif_data
+            cls._exif_data_cache.move_to_end(key)
+            while len(cls._exif_data_cache) > cls.EXIF_DATA_CACHE_SIZE:
+                cls._exif_data_cache.popitem(last=False)
+
+    @staticmethod
+    def _file_key(file: Path) -> Tuple[str, int, int]:
+        """(path, mtime_ns, size) identifying the current state of a file"""
+        stat = file.stat()
+        return str(file.resolve()), stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _exif_cache_file(log_path: Optional[Path], exif_cache: bool
+                         ) -> Optional[Path]:
+        """persistent exif cache database in <log_path> (None if disabled)"""
+        if not exif_cache:
+            return None
+        if log_path is None:
+            log_path = Path.cwd()
+        return log_path.joinpath(PrivateTools.EXIF_CACHE_FILENAME)
+
+    @classmethod
+    def _exif_cache_conn(cls, cache_file: Path) -> sqlite3.Connection:
+        """
+        Connection of the current thread to the persistent exif cache
+        (sqlite connections cannot be shared between threads). Entries
+        are keyed on <_file_key>, so changed files are simply cache misses
+        """
+        conns = cls._exif_cache_local.__dict__.setdefault('conns', {})
+        conn = conns.get(cache_file)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(cache_file)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with cls._exif_data_lock:
+            if cache_file not in cls._exif_cache_schemas:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS payloads(path TEXT PRIMARY"
+                    " KEY, mtime_ns INTEGER, size INTEGER, exif BLOB,"
+                    " icc_profile BLOB, photoshop BLOB)")
+                cls._exif_cache_schemas.add(cache_file)
+        conns[cache_file] = conn
+        return conn
+
+    @classmethod
+    def _close_exif_cache_conns(cls) -> None:
+        """close the exif cache connections of the current thread"""
+        conns = cls._exif_cache_local.__dict__.pop('conns', {})
+        for conn in conns.values():
+            conn.close()
+        with cls._exif_data_lock:
+            cls._exif_cache_schemas.clear()
+
+    @classmethod
+    def _cache_lookup(cls, cache_file: Optional[Path],
+                      keys: List[Tuple[str, int, int]]
+                      ) -> List[Optional[dict]]:
+        """raw info stored in the exif cache for each key (None if missing)"""
+        if cache_file is None or not keys:
+            return [None] * len(keys)
+        conn = cls._exif_cache_conn(cache_file)
+        query = "SELECT exif, icc_profile, photoshop FROM payloads" \
+            " WHERE path=? AND mtime_ns=? AND size=?"
+        rows = [conn.execute(query, key).fetchone() for key in keys]
+        return [None if row is None else
+                {kwd: val for kwd, val in zip(cls.EXIF_CACHE_PAYLOADS, row)
+                 if val is not None} for row in rows]
+
+    @classmethod
+    def _cache_store(cls, cache_file: Optional[Path],
+                     entries: List[Tuple[Tuple[str, int, int], dict]]
+                     ) -> None:
+        """
+        Store the (key, raw info) entries in the exif cache. Only the info
+        of JPEG files (payload bytes) is stored, Pillow info is not
+        """
+        if cache_file is None:
+            return
+        payloads = cls.EXIF_CACHE_PAYLOADS
+        rows = [(*key, *map(info.get, payloads)) for key, info in entries
+                if all(kwd in payloads and isinstance(val, bytes)
+                       for kwd, val in info.items())]
+        if not rows:
+            return
+        conn = cls._exif_cache_conn(cache_file)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO payloads VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
 
     @staticmethod
     def _gps2val(gps_metadata_tuple: tuple, zone_positive: bool):
         """convert raw gps-metadata field to a float"""
-        degs = gps_metadata_tuple[0][0] / gps_metadata_tuple[0][1]
-        mins = gps_metadata_tuple[1][0] / gps_metadata_tuple[1][1]
-        secs = gps_metadata_tuple[2][0] / gps_metadata_tuple[2][1]
-        return convert.dms_zone2deg(degs, mins, secs, zone_positive)
+        (deg_n, deg_d), (min_n, min_d), (sec_n, sec_d) = gps_metadata_tuple
+        return (2 * zone_positive - 1) * (
+            deg_n / deg_d + min_n / (60 * min_d) + sec_n / (3600 * sec_d))
+
+    @staticmethod
+    def _val2gps(dms_zone: tuple) -> tuple:
+        """convert a degrees-minutes-seconds-zone to a raw gps-metadata"""
+        scale = PrivateTools.GPS_SCALE
+        return ((dms_zone[0], 1), (dms_zone[1], 1),
+                (int(dms_zone[2] * scale), scale))
 
 
 class PilBaseClass(PrivateTools):
@@ -77,12 +311,28 @@ class PilBaseClass(PrivateTools):
              PyKernel (Python based Kernel) Docstring for Development
     --------------------------------------------------------------------------
     """
-    def __init__(self, logger=True, log_path=Path.cwd()) -> None:
+    __slots__ = ('_log_enabled', 'log', '_exif_cache')
+
+    def __init__(self, logger=True, log_path: Optional[Path] = None,
+                 exif_cache=False) -> None:
+        if log_path is None:
+            log_path = Path.cwd()
         self._log_enabled = logger
         if logger:
             self.log = logtools.get_fast_logger('Pilexifmgr', log_path)
         else:
             self.log = logging.getLogger("")
+        self._exif_cache = self._exif_cache_file(log_path, exif_cache)
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """
+        Clear the in-memory cache of loaded exif data and close the exif
+        cache connections of the current thread
+        """
+        with cls._exif_data_lock:
+            cls._exif_data_cache.clear()
+        cls._close_exif_cache_conns()
 
     @staticmethod
     def help_dev() -> Optional[str]:
@@ -4,14 +4,41 @@ PilExifManager (Pillow-Piexif Manager/wrapper)
 ------------------------------------------------------------------------------
 """
 from typing import Optional, Tuple, List
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
 import datetime
+import operator
+import os
 
 import piexif
 from kjmarotools.basics import filetools, convert
 
 from .baseclass import PilBaseClass
 
+# piexif tag indexes resolved once (hot paths avoid the double lookup)
+_DATE_DIGITIZED = piexif.ExifIFD.DateTimeDigitized
+_DATE_ORIGINAL = piexif.ExifIFD.DateTimeOriginal
+_EXIF_VERSION = piexif.ExifIFD.ExifVersion
+_SUBSEC_DIGITIZED = piexif.ExifIFD.SubSecTimeDigitized
+_SUBSEC_ORIGINAL = piexif.ExifIFD.SubSecTimeOriginal
+_GPS_ALT = piexif.GPSIFD.GPSAltitude
+_GPS_ALT_REF = piexif.GPSIFD.GPSAltitudeRef
+_GPS_LAT = piexif.GPSIFD.GPSLatitude
+_GPS_LAT_REF = piexif.GPSIFD.GPSLatitudeRef
+_GPS_LON = piexif.GPSIFD.GPSLongitude
+_GPS_LON_REF = piexif.GPSIFD.GPSLongitudeRef
+_GPS_VERSION = piexif.GPSIFD.GPSVersionID
+_ARTIST = piexif.ImageIFD.Artist
+_COPYRIGHT = piexif.ImageIFD.Copyright
+_DESCRIPTION = piexif.ImageIFD.ImageDescription
+_MAKE = piexif.ImageIFD.Make
+_MODEL = piexif.ImageIFD.Model
+_ORIENTATION = piexif.ImageIFD.Orientation
+_SOFTWARE = piexif.ImageIFD.Software
+_XP_KEYWORDS = piexif.ImageIFD.XPKeywords
+_GPS_FIELDS = operator.itemgetter(_GPS_LAT, _GPS_LAT_REF, _GPS_LON,
+                                  _GPS_LON_REF, _GPS_ALT, _GPS_ALT_REF)
+
 
 class PilExifManager(PilBaseClass):
     """
@@ -22,31 +49,57 @@ class PilExifManager(PilBaseClass):
     - New future compatible extensions must be added to:
         > EDITABLE_EXTENSIONS
         > READABLE_EXTENSIONS
+    - exif_cache: If True, the loaded metadata is kept in a persistent
+      database in <log_path> so unchanged files are not parsed again
     --------------------------------------------------------------------------
     """
     # pylint: disable=too-many-public-methods
+    __slots__ = ('metadata', '_filepath', '_temporal_keywords')
     EDITABLE_EXTENSIONS = "JPG", "JPEG"
     READABLE_EXTENSIONS = EDITABLE_EXTENSIONS + ("PNG", )
 
-    def __init__(self, logger=True, log_path=Path.cwd()) -> None:
-        super().__init__(logger, log_path)
+    def __init__(self, logger=True, log_path: Optional[Path] = None,
+                 exif_cache=False) -> None:
+        super().__init__(logger, log_path, exif_cache)
         self.metadata: dict = {}
         self._filepath: Optional[Path] = None
         self._temporal_keywords: List[str] = []
 
+    def _set_tag(self, ifd: str, tag: int, value) -> None:
+        """set a tag in the <ifd> data (the ifd is added if missing)"""
+        self.metadata.setdefault(ifd, {})[tag] = value
+
+    def _get_0th_str(self, tag: int) -> str:
+        """get a text tag of the <image> data (empty string if missing)"""
+        value = self.metadata.get('0th', {}).get(tag, "")
+        if isinstance(value, bytes):
+            return value.decode('utf-8', errors='replace')
+        return value
+
+    def _get_datetime(self, tag: int) -> datetime.datetime:
+        """get a datetime tag of the <Exif> data (year 1 if not valid)"""
+        dttkn = self.metadata['Exif'][tag]
+        try:
+            return convert.str2datetime(dttkn.decode('utf-8'), ":", " ", ":")
+        except ValueError:
+            return datetime.datetime(1, 1, 1)
+
+    def _set_datetime(self, tag: int, subsec_tag: int,
+                      new_datetime: datetime.datetime) -> None:
+        """set a datetime tag (and its sub-seconds) in the <Exif> data"""
+        datetime2add = convert.datetime2str(new_datetime, ":", " ", ":")
+        exif = self.metadata.setdefault('Exif', {})
+        exif[subsec_tag] = b'00'
+        exif[tag] = datetime2add.encode('utf-8')
+
     @property
     def metadata_as_string(self) -> str:
         """return the metadata in string format"""
-        if not self.metadata:
-            return ""
-        spacer = max([len(x) for x in list(self.metadata.keys())])
-        out_str = ""
-        for kwd in list(self.metadata.keys()):
-            if kwd == "thumbnail":
-                continue
-            new_line = ("{:<" + str(spacer) + "} | ").format(kwd)
-            out_str += new_line + str(self.metadata[kwd]) + "\n"
-        return out_str
+        spacer = max(map(len, self.metadata), default=0)
+        line_fmt = "{:<" + str(spacer) + "} | {}\n"
+        return "".join(line_fmt.format(kwd, val)
+                       for kwd, val in self.metadata.items()
+                       if kwd != "thumbnail")
 
     @property
     def has_gps_data(self) -> bool:
@@ -61,12 +114,12 @@ class PilExifManager(PilBaseClass):
     @property
     def has_date_original(self) -> bool:
         """DateTimeOriginal"""
-        return piexif.ExifIFD.DateTimeOriginal in self.metadata['Exif']
+        return _DATE_ORIGINAL in self.metadata.get('Exif', ())
 
     @property
     def has_date_digitized(self) -> bool:
         """DateTimeDigitized"""
-        return piexif.ExifIFD.DateTimeDigitized in self.metadata['Exif']
+        return _DATE_DIGITIZED in self.metadata.get('Exif', ())
 
     @property
     def has_valid_date_original(self) -> bool:
@@ -82,16 +135,117 @@ class PilExifManager(PilBaseClass):
             return self.get_date_digitized().year != 1
         return False
 
+    @classmethod
+    def _check_readable(cls, file: Path) -> None:
+        """raise ValueError if the file is not compatible with reading"""
+        readable = cls.READABLE_EXTENSIONS
+        if file.suffix[1:].upper() not in readable:
+            raise ValueError(
+                f"File '{file.name}' not compatible with metadata reading"
+                f" [Compatible Formats = {readable}]")
+
+    def _set_loaded_file(self, file: Path, metadata: dict) -> None:
+        """set the loaded file and its metadata"""
+        self._filepath = file
+        self.metadata = metadata
+        self._temporal_keywords = [kwd for kwd in self.get_keywords() if kwd]
+
     def load_file(self, file: Path) -> None:
         """load file"""
         if self._log_enabled:
             self.log.info("[PilexifMgr] Loading file: %s", file)
-        err_msg = f"File '{file.name}' not compatible with metadata reading"
-        err_msg += f" [Compatible Formats = {self.READABLE_EXTENSIONS}]"
-        assert file.suffix[1:].upper() in self.READABLE_EXTENSIONS, err_msg
-        self._temporal_keywords = []
-        self._filepath = file
-        self.metadata = self._load_exif_data(file)
+        self._check_readable(file)
+        key = self._file_key(file)
+        metadata = self._get_cached_exif_data(key)
+        if metadata is None:
+            info = self._cache_lookup(self._exif_cache, [key])[0]
+            if info is None:
+                info, metadata = self._read_exif_data(file)
+                self._cache_store(self._exif_cache, [(key, info)])
+            else:
+                metadata = self._exif_data_from_info(info)
+            self._put_cached_exif_data(key, metadata)
+        self._set_loaded_file(file, metadata)
+
+    @classmethod
+    def _preload_exif_data(cls, files: List[Path], cache_file: Optional[Path],
+                           executor: Executor, workers: int) -> None:
+        """
+        Keep the exif data of <files> in the in-memory cache, parsing in the
+        <executor> only the files missing in the exif cache (<cache_file>).
+        Files that cannot be read are skipped (load_file raises the error)
+        """
+        pending = {}
+        for file in files:
+            try:
+                key = cls._file_key(file)
+            except OSError:
+                continue
+            if key not in cls._exif_data_cache:
+                pending[key] = file
+        missing = {}
+        for (key, file), info in zip(
+                pending.items(), cls._cache_lookup(cache_file, list(pending))):
+            if info is None:
+                missing[key] = file
+            else:
+                cls._put_cached_exif_data(key, cls._exif_data_from_info(info))
+        if not missing:
+            return
+
+        chunksize = max(1, len(missing) // (workers * 4))
+        results = executor.map(cls._try_read_exif_data, missing.values(),
+                               chunksize=chunksize)
+        loaded = [(key, result) for key, result in zip(missing, results)
+                  if result is not None]
+        for key, (_, exif_data) in loaded:
+            cls._put_cached_exif_data(key, exif_data)
+        cls._cache_store(cache_file, [(key, info) for key, (info, _)
+                                      in loaded])
+
+    @classmethod
+    def load_files(cls, files: List[Path], workers: Optional[int] = None,
+                   logger=True, log_path: Optional[Path] = None,
+                   exif_cache=False) -> List[Optional['PilExifManager']]:
+        """
+        ----------------------------------------------------------------------
+        Load several files at once parsing them in a single process pool.
+        > files: files to load (a manager per file is returned in order)
+        > workers: number of processes (if None, os.cpu_count() is used)
+        > exif_cache: only the files missing in the cache are parsed
+        - A file that cannot be loaded gets None instead of a manager (and
+          the error is logged), the other files are loaded anyway. Files
+          with a not readable extension raise ValueError before loading
+        ----------------------------------------------------------------------
+        """
+        for file in files:
+            cls._check_readable(file)
+        managers: List[Optional[PilExifManager]] = []
+        if logger and files:
+            cls(logger, log_path).log.info("[PilexifMgr] Loading %s files",
+                                           len(files))
+
+        # files are parsed in batches that fit in the in-memory cache, so
+        # load_file finds them there
+        cache_file = cls._exif_cache_file(log_path, exif_cache)
+        workers = workers or os.cpu_count() or 1
+        step = cls.EXIF_DATA_CACHE_SIZE
+        with ProcessPoolExecutor(workers) as executor:
+            for idx in range(0, len(files), step):
+                cls._preload_exif_data(files[idx:idx + step], cache_file,
+                                       executor, workers)
+                for file in files[idx:idx + step]:
+                    mgr = cls(logger, log_path, exif_cache)
+                    try:
+                        mgr.load_file(file)
+                    except Exception as err:  # pylint: disable=broad-except
+                        if logger:
+                            mgr.log.error("[PilexifMgr] Cannot load file:"
+                                          " %s (%r)", file, err)
+                        managers.append(None)
+                    else:
+                        managers.append(mgr)
+        return managers
 
     def save_file(self, filename="", overwrite=False) -> None:
         """
@@ -102,10 +256,10 @@ class PilExifManager(PilBaseClass):
         ----------------------------------------------------------------------
         """
         assert self._filepath is not None
-        sfx = self._filepath.suffix[1:].upper()
-        err_msg = "File not compatible with metadata writing"
-        err_msg += f" [Compatible Formats = {self.EDITABLE_EXTENSIONS}]"
-        assert sfx not in self.EDITABLE_EXTENSIONS, err_msg
+        editable = self.EDITABLE_EXTENSIONS
+        if self._filepath.suffix[1:].upper() not in editable:
+            raise ValueError("File not compatible with metadata writing"
+                             f" [Compatible Formats = {editable}]")
 
         exif_bytes = piexif.dump(self.metadata)
         base_path = self._filepath.parent
@@ -130,127 +284,89 @@ class PilExifManager(PilBaseClass):
         """
         returns the file metadata date original
         """
-        dttkn = self.metadata['Exif'][piexif.ExifIFD.DateTimeOriginal]
-        try:
-            return convert.str2datetime(dttkn.decode('utf-8'), ":", " ", ":")
-        except ValueError:
-            return datetime.datetime(1, 1, 1)
+        return self._get_datetime(_DATE_ORIGINAL)
 
     def get_date_digitized(self) -> datetime.datetime:
         """
         returns the file metadata date-taken field
         """
-        dttkn = self.metadata['Exif'][piexif.ExifIFD.DateTimeDigitized]
-        try:
-            return convert.str2datetime(dttkn.decode('utf-8'), ":", " ", ":")
-        except ValueError:
-            return datetime.datetime(1, 1, 1)
+        return self._get_datetime(_DATE_DIGITIZED)
 
     def get_gps_data(self) -> Tuple[float, float, float, bool]:
         """get the gps data in lat-lon-alt-altitude_in_msl"""
-        meta_dat = self.metadata['GPS'][piexif.GPSIFD.GPSLatitude]
-        zbn = self.metadata['GPS'][piexif.GPSIFD.GPSLatitudeRef]
-        zone_positive = zbn == b'N'
-        lat = self._gps2val(meta_dat, zone_positive)
-
-        meta_dat = self.metadata['GPS'][piexif.GPSIFD.GPSLongitude]
-        zbn = self.metadata['GPS'][piexif.GPSIFD.GPSLongitudeRef]
-        zone_positive = zbn == b'E'
-        lon = self._gps2val(meta_dat, zone_positive)
-
-        meta_dat = self.metadata['GPS'][piexif.GPSIFD.GPSAltitude]
-        alt_ref = self.metadata['GPS'][piexif.GPSIFD.GPSAltitudeRef]
-        alt = meta_dat[0] / meta_dat[1]
+        lat_dat, lat_ref, lon_dat, lon_ref, alt_dat, alt_ref = _GPS_FIELDS(
+            self.metadata['GPS'])
+        lat = self._gps2val(lat_dat, lat_ref == b'N')
+        lon = self._gps2val(lon_dat, lon_ref == b'E')
+        alt = alt_dat[0] / alt_dat[1]
         msl = alt_ref == 1
         return lat, lon, alt, msl
 
     def get_keywords(self) -> List[str]:
         """get video keywords as list of strings"""
         has0th = '0th' in self.metadata
-        kwd_idx = piexif.ImageIFD.XPKeywords
-        if has0th and kwd_idx in self.metadata['0th']:
-            tags_bytes = bytes(self.metadata['0th'][kwd_idx])
-            tags_str = tags_bytes.decode('utf-16').split("\x00", maxsplit=1)[0]
-            return tags_str.split(";")
+        if has0th and _XP_KEYWORDS in self.metadata['0th']:
+            tags_raw = self.metadata['0th'][_XP_KEYWORDS]
+            if isinstance(tags_raw, tuple):  # piexif loads XP tags as ints
+                tags_raw = bytes(tags_raw)
+            has_bom = tags_raw[:2] in (b'\xff\xfe', b'\xfe\xff')
+            tags_str = tags_raw.decode('utf-16' if has_bom else 'utf-16-le',
+                                       errors='replace')
+            end = tags_str.find("\x00")
+            return (tags_str[:end] if end >= 0 else tags_str).split(";")
         return []
 
     def get_camera_maker(self) -> str:
         """get camera maker as string"""
-        has0th = '0th' in self.metadata
-        if has0th and (piexif.ImageIFD.Make in self.metadata['0th']):
-            return self.metadata['0th'][piexif.ImageIFD.Make]
-        return ""
+        return self._get_0th_str(_MAKE)
 
     def get_camera_model(self) -> str:
         """get camera model as string"""
-        has0th = '0th' in self.metadata
-        if has0th and (piexif.ImageIFD.Model in self.metadata['0th']):
-            return self.metadata['0th'][piexif.ImageIFD.Model]
-        return ""
+        return self._get_0th_str(_MODEL)
 
     def get_description(self) -> str:
         """get the description"""
-        has0th = '0th' in self.metadata
-        idx_dsc = piexif.ImageIFD.ImageDescription
-        if has0th and (idx_dsc in self.metadata['0th']):
-            return self.metadata['0th'][idx_dsc]
-        return ""
+        return self._get_0th_str(_DESCRIPTION)
 
     def get_copyright(self) -> str:
         """get the copyright"""
-        has0th = '0th' in self.metadata
-        idx_cpr = piexif.ImageIFD.Copyright
-        if has0th and (idx_cpr in self.metadata['0th']):
-            return self.metadata['0th'][idx_cpr]
-        return ""
+        return self._get_0th_str(_COPYRIGHT)
 
     def set_date_original(self, new_datetime: datetime.datetime) -> None:
         """set_date_original"""
-        datetime2add = convert.datetime2str(new_datetime, ":", " ", ":")
-        self.metadata['Exif'][piexif.ExifIFD.SubSecTimeOriginal] = b'00'
-        self.metadata['Exif'][piexif.ExifIFD.DateTimeOriginal
-                              ] = datetime2add.encode('utf-8')
+        self._set_datetime(_DATE_ORIGINAL, _SUBSEC_ORIGINAL, new_datetime)
 
     def set_date_digitized(self, new_datetime: datetime.datetime) -> None:
         """set_date_digitized"""
-        datetime2add = convert.datetime2str(new_datetime, ":", " ", ":")
-        self.metadata['Exif'][piexif.ExifIFD.SubSecTimeDigitized] = b'00'
-        self.metadata['Exif'][piexif.ExifIFD.DateTimeDigitized
-                              ] = datetime2add.encode('utf-8')
+        self._set_datetime(_DATE_DIGITIZED, _SUBSEC_DIGITIZED, new_datetime)
 
     def set_artist(self, artist: str) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Artist
-                             ] = artist.encode('utf-8')
+        self._set_tag('0th', _ARTIST, artist.encode('utf-8'))
 
     def set_camera_maker(self, camera_maker: str) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Make
-                             ] = camera_maker.encode('utf-8')
+        self._set_tag('0th', _MAKE, camera_maker.encode('utf-8'))
 
     def set_camera_model(self, camera_model: str) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Model
-                             ] = camera_model.encode('utf-8')
+        self._set_tag('0th', _MODEL, camera_model.encode('utf-8'))
 
     def set_copyright(self, img_copyright: str) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Copyright
-                             ] = img_copyright.encode('utf-8')
+        self._set_tag('0th', _COPYRIGHT, img_copyright.encode('utf-8'))
 
     def set_exif_version(self, version="0220") -> None:
         """add the field to the <Exif> data"""
-        self.metadata['Exif'][piexif.ExifIFD.ExifVersion
-                              ] = version.encode('utf-8')
+        self._set_tag('Exif', _EXIF_VERSION, version.encode('utf-8'))
 
     def set_software(self, software: str) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Software
-                             ] = software.encode('utf-8')
+        self._set_tag('0th', _SOFTWARE, software.encode('utf-8'))
 
     def set_orientation(self, orientation: int) -> None:
         """add the field to the <image> data"""
-        self.metadata['0th'][piexif.ImageIFD.Orientation] = orientation
+        self._set_tag('0th', _ORIENTATION, orientation)
 
     def set_gps_data(self, lat: float, lon: float, alt: float,
                      mean_sea_level=True) -> None:
@@ -258,31 +374,23 @@ class PilExifManager(PilBaseClass):
         lat_dmsz = convert.deg2dms_zone(lat, ("N", "S"))
         lon_dmsz = convert.deg2dms_zone(lon, ("E", "W"))
 
-        gps_lat = ((lat_dmsz[0], 1), (lat_dmsz[1], 1),
-                   (int(lat_dmsz[2] * 100), 100))
-        gps_log = ((lon_dmsz[0], 1), (lon_dmsz[1], 1),
-                   (int(lon_dmsz[2] * 100), 100))
-
-        self.metadata['GPS'][piexif.GPSIFD.GPSVersionID] = (2, 2, 0, 0)
-        self.metadata['GPS'][piexif.GPSIFD.GPSAltitudeRef] = int(
-            mean_sea_level)
-        self.metadata['GPS'][piexif.GPSIFD.GPSLatitudeRef] = lat_dmsz[3]
-        self.metadata['GPS'][piexif.GPSIFD.GPSLongitudeRef] = lon_dmsz[3]
-        self.metadata['GPS'][piexif.GPSIFD.GPSLatitude] = gps_lat
-        self.metadata['GPS'][piexif.GPSIFD.GPSLongitude] = gps_log
-        self.metadata['GPS'][piexif.GPSIFD.GPSAltitude] = (
-            int(alt * 100), 100)
+        gps = self.metadata.setdefault('GPS', {})
+        gps[_GPS_VERSION] = (2, 2, 0, 0)
+        gps[_GPS_ALT_REF] = int(mean_sea_level)
+        gps[_GPS_LAT_REF] = lat_dmsz[3]
+        gps[_GPS_LON_REF] = lon_dmsz[3]
+        gps[_GPS_LAT] = self._val2gps(lat_dmsz)
+        gps[_GPS_LON] = self._val2gps(lon_dmsz)
+        gps[_GPS_ALT] = (int(alt * self.GPS_SCALE), self.GPS_SCALE)
 
     def add_keywords(self, keywords: list, overwrite=False) -> None:
         """add keywords (overwrite keywords if desired)"""
         assert isinstance(keywords, list), "<keys2add> must be a list"
-        if not overwrite:
-            new_keys2add = []
-            for kwd in keywords:
-                if kwd not in self._temporal_keywords:
-                    new_keys2add.append(kwd)
-            new_keywords = ";".join(self._temporal_keywords + new_keys2add)
-        else:
-            new_keywords = ";".join(keywords)
-        utf16_keywords = new_keywords.encode('utf-16')
-        self.metadata['0th'][piexif.ImageIFD.XPKeywords] = utf16_keywords
+        if overwrite:
+            self._temporal_keywords = list(keywords)
+        else:  # dict keeps the order and skips the repeated keywords
+            self._temporal_keywords = list(
+                dict.fromkeys(self._temporal_keywords + keywords))
+        # XPKeywords is NUL-terminated UTF-16LE text (no BOM)
+        new_keywords = ";".join(self._temporal_keywords) + "\x00"
+        self._set_tag('0th', _XP_KEYWORDS, new_keywords.encode('utf-16-le'))
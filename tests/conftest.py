@@ -0,0 +1,34 @@
+"""shared fixtures of the tests"""
+from io import BytesIO
+from pathlib import Path
+
+import piexif
+import pytest
+from PIL import Image
+
+from kpilexifmanager import PilExifManager
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """every test starts without cached exif data"""
+    PilExifManager.clear_cache()
+    yield
+    PilExifManager.clear_cache()
+
+
+@pytest.fixture(name='write_jpeg')
+def fixture_write_jpeg(tmp_path):
+    """factory writing small JPEGs with the given <0th> tags in tmp_path"""
+    def write_jpeg(name='image.jpg', make=b'Canon', **zeroth) -> Path:
+        tags = {piexif.ImageIFD.Make: make}
+        tags.update((getattr(piexif.ImageIFD, tag), val)
+                    for tag, val in zeroth.items())
+        exif = piexif.dump({'0th': tags, 'Exif': {
+            piexif.ExifIFD.DateTimeOriginal: b'2020:01:02 03:04:05'}})
+        buf = BytesIO()
+        Image.new('RGB', (16, 16)).save(buf, 'JPEG', exif=exif)
+        file = tmp_path.joinpath(name)
+        file.write_bytes(buf.getvalue())
+        return file
+    return write_jpeg
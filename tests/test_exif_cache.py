@@ -0,0 +1,79 @@
+"""in-memory and persistent caches of the loaded exif data"""
+import os
+
+import pytest
+
+from kpilexifmanager import PilExifManager
+
+
+def _load(file, **params) -> PilExifManager:
+    """manager with <file> loaded"""
+    mgr = PilExifManager(logger=False, **params)
+    mgr.load_file(file)
+    return mgr
+
+
+def _rewrite(write_jpeg, file, make: bytes, mtime_ns: int) -> None:
+    """replace <file> by a same-size JPEG of <make> with <mtime_ns>"""
+    size = file.stat().st_size
+    write_jpeg(file.name, make)
+    assert file.stat().st_size == size
+    os.utime(file, ns=(mtime_ns, mtime_ns))
+
+
+def test_persistent_cache_hit(write_jpeg, tmp_path):
+    """an unchanged file is served from the database"""
+    file = write_jpeg()
+    mtime_ns = file.stat().st_mtime_ns
+    expected = _load(file, log_path=tmp_path, exif_cache=True).metadata
+    assert tmp_path.joinpath(PilExifManager.EXIF_CACHE_FILENAME).exists()
+
+    # same key (path, mtime, size) with other content: only a hit is Canon
+    _rewrite(write_jpeg, file, b'Nikon', mtime_ns)
+    PilExifManager.clear_cache()
+    mgr = _load(file, log_path=tmp_path, exif_cache=True)
+    assert mgr.metadata == expected
+    assert mgr.get_camera_maker() == "Canon"
+    PilExifManager.clear_cache()
+    assert _load(file).get_camera_maker() == "Nikon"
+
+
+def test_persistent_cache_changed_file(write_jpeg, tmp_path):
+    """a changed file is parsed again"""
+    file = write_jpeg()
+    mtime_ns = file.stat().st_mtime_ns
+    _load(file, log_path=tmp_path, exif_cache=True)
+    _rewrite(write_jpeg, file, b'Nikon', mtime_ns + 10**9)
+    PilExifManager.clear_cache()
+    mgr = _load(file, log_path=tmp_path, exif_cache=True)
+    assert mgr.get_camera_maker() == "Nikon"
+
+
+def test_memory_cache_isolated(write_jpeg):
+    """edits of a manager do not reach a later load of the same file"""
+    file = write_jpeg()
+    mgr = _load(file)
+    expected = {kwd: dict(val) if isinstance(val, dict) else val
+                for kwd, val in mgr.metadata.items()}
+    mgr.set_camera_maker("Edited")
+    mgr.add_keywords(["edited"])
+    mgr.metadata['Exif'].clear()
+    del mgr.metadata['0th']
+    mgr.metadata['extra'] = b''
+    again = _load(file)
+    assert again.metadata == expected
+    assert again.get_camera_maker() == "Canon"
+    assert again.get_keywords() == []
+
+
+@pytest.mark.parametrize('make, mtime_shift', [(b'Nikon', 10**9),
+                                               (b'Sony Corp', 0)])
+def test_memory_cache_changed_file(write_jpeg, make, mtime_shift):
+    """a new mtime (same size) or a new size (same mtime) is parsed again"""
+    file = write_jpeg()
+    stat = file.stat()
+    assert _load(file).get_camera_maker() == "Canon"
+    write_jpeg(file.name, make)
+    os.utime(file, ns=(stat.st_mtime_ns, stat.st_mtime_ns + mtime_shift))
+    assert (file.stat().st_size == stat.st_size) == bool(mtime_shift)
+    assert _load(file).get_camera_maker() == make.decode()
@@ -0,0 +1,136 @@
+"""JPEG segment scanner against Pillow on generated files"""
+# pylint: disable=protected-access
+from io import BytesIO
+from pathlib import Path
+import struct
+
+import piexif
+import pytest
+from PIL import Image, UnidentifiedImageError
+
+from kpilexifmanager import PilExifManager
+
+ICC_PROFILE = bytes(range(256)) * 600  # > 2 APP2 chunks
+
+
+def _jpeg(**params) -> bytes:
+    """small JPEG with a GPS/Exif block and a multi-chunk ICC profile"""
+    exif = piexif.dump({
+        '0th': {piexif.ImageIFD.Make: b'Canon'},
+        'Exif': {piexif.ExifIFD.DateTimeOriginal: b'2020:01:02 03:04:05'},
+        'GPS': {piexif.GPSIFD.GPSLatitudeRef: b'N',
+                piexif.GPSIFD.GPSLatitude: ((40, 1), (25, 1), (1234, 100))}})
+    buf = BytesIO()
+    Image.new('RGB', (16, 16)).save(buf, 'JPEG', exif=exif,
+                                    icc_profile=ICC_PROFILE, **params)
+    return buf.getvalue()
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    """raw APP segment"""
+    return bytes((0xFF, marker)) + struct.pack('>H', len(payload) + 2) \
+        + payload
+
+
+def _after_soi(jpeg: bytes, extra: bytes) -> bytes:
+    """insert raw bytes right after the SOI marker"""
+    return jpeg[:2] + extra + jpeg[2:]
+
+
+def _write(tmp_path: Path, data: bytes, name='image.jpg') -> Path:
+    """write <data> in a file in <tmp_path>"""
+    file = tmp_path.joinpath(name)
+    file.write_bytes(data)
+    return file
+
+
+def _pillow_info(file: Path) -> dict:
+    """<img.info> of the file opened by Pillow"""
+    with Image.open(file) as img:
+        return img.info
+
+
+def _assert_as_pillow(file: Path) -> None:
+    """the scanned exif and icc profile are the ones Pillow reads"""
+    info = PilExifManager._read_jpeg_info(file)
+    pillow_info = _pillow_info(file)
+    assert info['exif'] == pillow_info['exif']
+    assert info['icc_profile'] == pillow_info['icc_profile']
+
+
+def test_plain_jpeg(tmp_path):
+    """APP1 exif and APP2 icc chunks"""
+    _assert_as_pillow(_write(tmp_path, _jpeg()))
+
+
+def test_fill_bytes(tmp_path):
+    """0xFF fill bytes before a marker"""
+    jpeg = _jpeg()
+    _assert_as_pillow(_write(tmp_path, _after_soi(jpeg, b'\xff\xff\xff')))
+
+
+def test_segments_past_the_head(tmp_path):
+    """exif segment beyond the EXIF_HEAD_SIZE read"""
+    junk = _segment(0xE3, bytes(65000)) * 2
+    jpeg = _after_soi(_jpeg(), junk)
+    assert jpeg.index(b'Exif\x00\x00') > PilExifManager.EXIF_HEAD_SIZE
+    _assert_as_pillow(_write(tmp_path, jpeg))
+
+
+def test_truncated_head():
+    """truncated or non-JPEG data raises ValueError"""
+    jpeg = _jpeg()
+    with pytest.raises(ValueError):
+        PilExifManager._scan_jpeg_segments(jpeg[:jpeg.index(b'Exif') + 10])
+    with pytest.raises(ValueError):
+        PilExifManager._scan_jpeg_segments(jpeg[:2])
+    with pytest.raises(ValueError):
+        PilExifManager._scan_jpeg_segments(b'\x89PNG\r\n\x1a\n')
+
+
+@pytest.mark.parametrize('payload', [b'ICC_PROFILE\x00',
+                                     b'ICC_PROFILE\x00\x01'])
+def test_short_icc_segment(tmp_path, payload):
+    """ICC segment without chunk numbers: not a JPEG for both readers"""
+    jpeg = _after_soi(_jpeg(), _segment(0xE2, payload))
+    with pytest.raises(ValueError):
+        PilExifManager._scan_jpeg_segments(jpeg)
+    with pytest.raises(UnidentifiedImageError):
+        PilExifManager(logger=False).load_file(_write(tmp_path, jpeg))
+
+
+def test_truncated_file(tmp_path):
+    """file ending inside an APP segment"""
+    jpeg = _jpeg()
+    file = _write(tmp_path, jpeg[:jpeg.index(b'ICC_PROFILE') + 100])
+    with pytest.raises(ValueError):
+        PilExifManager._read_jpeg_info(file)
+
+
+def test_non_jpeg_fallback(tmp_path):
+    """PNG data with a .jpg suffix is read by Pillow"""
+    buf = BytesIO()
+    exif = piexif.dump({'0th': {piexif.ImageIFD.Make: b'Canon'}})
+    Image.new('RGB', (16, 16)).save(buf, 'PNG', exif=exif)
+    file = _write(tmp_path, buf.getvalue())
+    assert PilExifManager._read_info(file) == _pillow_info(file)
+    mgr = PilExifManager(logger=False)
+    mgr.load_file(file)
+    assert mgr.get_camera_maker() == "Canon"
+
+
+@pytest.mark.parametrize('name', ['image.jpg', 'image.png'])
+@pytest.mark.parametrize('data', [b'', b'garbage', bytes(range(47))])
+def test_unidentified_file(tmp_path, name, data):
+    """empty or corrupt files raise the Pillow error"""
+    with pytest.raises(UnidentifiedImageError):
+        PilExifManager(logger=False).load_file(_write(tmp_path, data, name))
+
+
+def test_load_file(tmp_path):
+    """metadata of a loaded JPEG"""
+    mgr = PilExifManager(logger=False)
+    mgr.load_file(_write(tmp_path, _jpeg()))
+    assert mgr.get_camera_maker() == "Canon"
+    assert mgr.has_valid_date_original
+    assert mgr.metadata['icc_profile'] == ICC_PROFILE
@@ -0,0 +1,44 @@
+"""XPKeywords reading and writing"""
+import piexif
+import pytest
+
+from kpilexifmanager import PilExifManager
+
+
+def _load(file) -> PilExifManager:
+    """manager with <file> loaded"""
+    mgr = PilExifManager(logger=False)
+    mgr.load_file(file)
+    return mgr
+
+
+def test_written_keywords(write_jpeg, tmp_path):
+    """keywords are written as NUL-terminated UTF-16LE and read back"""
+    mgr = _load(write_jpeg())
+    mgr.add_keywords(["sea", "año"])
+    mgr.save_file("saved.jpg", overwrite=True)
+    saved = _load(tmp_path.joinpath("saved.jpg"))
+    assert bytes(saved.metadata['0th'][piexif.ImageIFD.XPKeywords]) == \
+        "sea;año\x00".encode('utf-16-le')
+    assert saved.get_keywords() == ["sea", "año"]
+
+
+@pytest.mark.parametrize('encoding', ['utf-16', 'utf-16-be'])
+def test_bom_keywords(write_jpeg, encoding):
+    """values with a BOM (older writers) are read and extended"""
+    raw = "sea;sky".encode(encoding)
+    if encoding == 'utf-16-be':
+        raw = b'\xfe\xff' + raw
+    mgr = _load(write_jpeg(XPKeywords=raw))
+    assert mgr.get_keywords() == ["sea", "sky"]
+    mgr.add_keywords(["sky", "sun"])
+    assert mgr.get_keywords() == ["sea", "sky", "sun"]
+
+
+@pytest.mark.parametrize('raw', [b'a\x00b', b'\x00\xd8;\x00b\x00'])
+def test_malformed_keywords(write_jpeg, raw):
+    """odd-length or lone-surrogate values do not break the loading"""
+    mgr = _load(write_jpeg(XPKeywords=raw))
+    assert "\ufffd" in "".join(mgr.get_keywords())
+    mgr.add_keywords(["new"])
+    assert mgr.get_keywords()[-1] == "new"
@@ -0,0 +1,51 @@
+"""batch loading through a process pool"""
+import os
+
+import pytest
+
+from kpilexifmanager import PilExifManager
+
+
+def test_load_files(write_jpeg, tmp_path, monkeypatch):
+    """order, duplicated paths and bad files across several batches"""
+    monkeypatch.setattr(PilExifManager, 'EXIF_DATA_CACHE_SIZE', 3)
+    files = [write_jpeg(f"{idx}.jpg", f"Maker{idx}".encode())
+             for idx in range(7)]
+    bad = tmp_path.joinpath("bad.jpg")
+    bad.write_bytes(b'garbage')
+    files = files[:4] + [bad, tmp_path.joinpath("missing.jpg")] \
+        + files[4:] + [files[1], files[6]]
+
+    mgrs = PilExifManager.load_files(files, workers=2, logger=False)
+    assert len(mgrs) == len(files)
+    assert mgrs[4] is None and mgrs[5] is None
+    for file, mgr in zip(files, mgrs):
+        if mgr is not None:
+            assert mgr.get_camera_maker() == f"Maker{file.stem}"
+    first, again = mgrs[1], mgrs[-2]
+    assert first is not None and again is not None and first is not again
+    first.set_camera_maker("Edited")
+    assert again.get_camera_maker() == "Maker1"
+
+
+def test_load_files_cached(write_jpeg, tmp_path):
+    """files in the exif cache are not parsed again"""
+    files = [write_jpeg(f"{idx}.jpg") for idx in range(3)]
+    params = {'logger': False, 'log_path': tmp_path, 'exif_cache': True}
+    PilExifManager.load_files(files, workers=1, **params)
+
+    # same (path, mtime, size) with other content: only a hit is Canon
+    stat = files[1].stat()
+    write_jpeg(files[1].name, b'Nikon')
+    assert files[1].stat().st_size == stat.st_size
+    os.utime(files[1], ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+    PilExifManager.clear_cache()
+    mgrs = PilExifManager.load_files(files, workers=1, **params)
+    assert [mgr.get_camera_maker() for mgr in mgrs if mgr] == ["Canon"] * 3
+
+
+def test_load_files_not_readable(tmp_path):
+    """not readable extensions are rejected before loading"""
+    with pytest.raises(ValueError):
+        PilExifManager.load_files([tmp_path.joinpath("image.gif")],
+                                  logger=False)